@@ -9,6 +9,30 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        # list of database files the posts are spread over, by author (see
+        # flaskr/db.py). None keeps everything in DATABASE. Shards may only
+        # be appended, since the position of a shard is part of its post ids.
+        # When sharding an existing deployment, DATABASE must be listed as
+        # the first shard, since it holds all existing posts (create_app()
+        # fails otherwise).
+        # After appending one, run 'flask init-shards' to create its tables
+        # (it also upgrades databases created by an older schema.sql)
+        DATABASE_SHARDS=None,
+        # number of threads querying the shards in parallel, shared by all
+        # requests. None means 8 per shard, enough for 8 concurrent requests
+        DATABASE_SHARD_THREADS=None,
+        # number of prepared statements sqlite3 keeps per connection, must be
+        # at least the number of queries registered in flaskr/queries.py. The
+        # connections are closed at the end of each request, so the cache
+        # only helps within one request
+        DATABASE_STATEMENT_CACHE=128,
+        # serve the per-query timings collected by flaskr/queries.py as JSON
+        # at /_queries
+        QUERY_TIMINGS_ENDPOINT=False,
+        # number of posts in the Atom and RSS feeds
+        FEED_LENGTH=20,
+        # number of posts on each page of the index
+        POSTS_PER_PAGE=50,
     )
 
     # have your tests use a different config than the real application
@@ -34,6 +58,10 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    # the queries module collects the per-query timings
+    from . import queries
+    queries.init_app(app)
+
     # register the blueprint ('auth.bd')
     from . import auth
     app.register_blueprint(auth.bp)
@@ -46,4 +74,9 @@ def create_app(test_config=None):
     # so
     app.add_url_rule('/', endpoint='index')
 
+    # the feed module registers its own blueprint ('feed.bp') and the cache
+    # of the rendered feed entries
+    from . import feed
+    feed.init_app(app)
+
     return app
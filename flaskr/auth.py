@@ -6,6 +6,7 @@ from flask import (
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from flaskr.db import get_db
+from flaskr.queries import users
 
 # A blueprint contains multiple views
 # A view function is a code you write to respond to requests
@@ -31,16 +32,11 @@ def register():
             error = 'Username is required.'
         elif not password:
             error = 'Password is required.'
-        elif db.execute(
-            'SELECT id FROM user WHERE username = ?', (username,)
-        ).fetchone() is not None:
+        elif users().get_by_username(username) is not None:
             error = 'User {} is already registered.'.format(username)
 
         if error is None:
-            db.execute(
-                'INSERT INTO user (username, password) VALUES (?, ?)',
-                (username, generate_password_hash(password))
-            )
+            users().create(username, generate_password_hash(password))
             db.commit()
             # 'url_for' creates the URL for the given endpoint
             # here: auth_login is used which refers to the login() function,
@@ -60,11 +56,8 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        db = get_db()
         error = None
-        user = db.execute(
-            'SELECT * FROM user WHERE username = ?', (username,)
-        ).fetchone()
+        user = users().get_by_username(username)
 
         if user is None:
             error = 'Incorrect username.'
@@ -98,9 +91,7 @@ def load_logged_in_user():
     if user_id is None:
         g.user = None
     else:
-        g.user = get_db().execute(
-            'SELECT * FROM user WHERE id = ?', (user_id,)
-        ).fetchone()
+        g.user = users().get(user_id)
 
 # the session can be emptied by calling the dict.clear() method
 @bp.route('/logout')
@@ -1,26 +1,53 @@
+import heapq
+import itertools
+
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request,
+    url_for
 )
 from werkzeug.exceptions import abort
 
 from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.db import get_db, get_post_shard_index, get_shard_db, map_shards
+from flaskr.queries import PostRepository, get_timings, posts, users
 
 # define another blueprint
 # there is no url_prefix, which means that this blueprint's root is '/'
 bp = Blueprint('blog', __name__)
 
 # render blog/index.html when 127.0.0.1:5000/ is called
+# the page starts right after the post given by the 'created' and 'id' values
+# of the request's query string (e.g. /?created=2018-01-01 00:00:00&id=1)
 @bp.route('/')
 def index():
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' ORDER BY created DESC'
-    ).fetchall()
-    # render index.html and pass posts variable into it
-    return render_template('blog/index.html', posts=posts)
+    limit = current_app.config['POSTS_PER_PAGE']
+    created = request.args.get('created')
+    before_id = request.args.get('id', type=int)
+    if created is None or before_id is None:
+        created = before_id = None
+
+    # each shard returns its newest 'limit' posts of the page, the queries run
+    # in parallel. The repositories are created here, since the worker threads
+    # can't access the application context
+    timings = get_timings()
+    pages = map_shards(
+        lambda db: PostRepository(db, timings).page(limit, created, before_id)
+    )
+    # every shard's list is already sorted, so merging them (k-way merge) and
+    # taking the first 'limit' posts gives the newest posts of all shards
+    page = list(itertools.islice(heapq.merge(
+        *pages, key=lambda post: (post['created'], post['id']), reverse=True
+    ), limit))
+
+    # the link to the next page, if there might be one
+    next_page = None
+    if len(page) == limit:
+        next_page = url_for(
+            'blog.index', created=str(page[-1]['created']), id=page[-1]['id']
+        )
+
+    # render index.html and pass the posts into it
+    return render_template('blog/index.html', posts=page, next_page=next_page)
 
 # render blog/create.html when 127.0.0.1:5000/create is called and user is logged in
 # render auth/login when user is not logged in -> @login_required
@@ -38,26 +65,31 @@ def create():
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'INSERT INTO post (title, body, author_id)'
-                ' VALUES (?, ?, ?)',
-                (title, body, g.user['id'])
-            )
+            # the post is stored on the author's shard. The shard also needs
+            # a copy of the author's user row, so the post can be joined with
+            # its author there. It is copied in the same transaction, which
+            # also covers authors moved to a newly appended shard
+            db = get_db(g.user['id'])
+            if db is not get_db():
+                users(db).copy(g.user)
+            posts(db).create(title, body, g.user['id'])
             db.commit()
             return redirect(url_for('blog.index'))
 
     return render_template('blog/create.html')
 
+# returns the connection to the shard holding the post with the given id
+def get_post_db(id):
+    index = get_post_shard_index(id)
+    if index is None:
+        abort(404, "Post id {0} doesn't exist.".format(id))
+
+    return get_shard_db(index)
+
 # return a post content as dict if the logged in user matches that blog's author
 # the post's 'id' value must be given -> see delete(id), update(id)
 def get_post(id, check_author=True):
-    post = get_db().execute(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' WHERE p.id = ?',
-        (id,)
-    ).fetchone()
+    post = posts(get_post_db(id)).get(id)
 
     # 'abort' raises a special exception that returns the HTTP status code
     # here: unknown blog id
@@ -96,13 +128,9 @@ def update(id):
         if error is not None:
             flash(error)
         else:
-            db = get_db()
             # Here the values are updated -> create() method uses INSERT
-            db.execute(
-                'UPDATE post SET title = ?, body = ?'
-                ' WHERE id = ?',
-                (title, body, id)
-            )
+            db = get_post_db(id)
+            posts(db).update(id, title, body)
             db.commit()
             return redirect(url_for('blog.index'))
 
@@ -114,7 +142,7 @@ def update(id):
 @login_required
 def delete(id):
     get_post(id)
-    db = get_db()
-    db.execute('DELETE FROM post WHERE id = ?', (id,))
+    db = get_post_db(id)
+    posts(db).delete(id)
     db.commit()
     return redirect(url_for('blog.index'))
@@ -1,38 +1,240 @@
+import bisect
+import concurrent.futures
+import hashlib
+import os
 import sqlite3
+import weakref
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+# Posts (and a copy of their author's user row) can be spread over several
+# database files, the shards, which are listed in the 'DATABASE_SHARDS'
+# config. Without it, 'DATABASE' is the only shard. 'DATABASE' itself always
+# holds all users: it hands out the user ids and keeps the usernames unique.
+#
+# The ids of the posts on shard N start at N << POST_ID_SHIFT (see init_db()),
+# so the shard of a post can be told from its id alone.
+POST_ID_SHIFT = 32
+
+
+def get_shards():
+    return current_app.config['DATABASE_SHARDS'] or [current_app.config['DATABASE']]
+
+
+# all database files, 'DATABASE' first
+def get_database_paths():
+    paths = [current_app.config['DATABASE']]
+    paths.extend(path for path in get_shards() if path not in paths)
+    return paths
+
+
+# Consistent hashing: each shard is put on a ring at 'replicas' positions, an
+# author belongs to the first shard following the author's position. When a
+# shard is appended to 'DATABASE_SHARDS', only the authors now landing on the
+# new shard's positions move.
+class HashRing(object):
+    def __init__(self, count, replicas=64):
+        self._ring = sorted(
+            (self._hash('{}-{}'.format(index, replica)), index)
+            for index in range(count)
+            for replica in range(replicas)
+        )
+        self._positions = [position for position, index in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf8')).hexdigest()[:16], 16)
+
+    def get(self, key):
+        i = bisect.bisect(self._positions, self._hash(str(key)))
+        return self._ring[i % len(self._ring)][1]
+
+
+# the ring is built once per application (and again if the shards change)
+def get_shard_index(author_id):
+    shards = get_shards()
+    count, ring = current_app.extensions.get('shard_ring', (None, None))
+    if count != len(shards):
+        ring = HashRing(len(shards))
+        current_app.extensions['shard_ring'] = (len(shards), ring)
+    return ring.get(author_id)
+
+
+# returns None for ids that don't belong to any shard
+def get_post_shard_index(post_id):
+    index = post_id >> POST_ID_SHIFT
+    return index if index < len(get_shards()) else None
+
+
+def connect(path):
+    db = sqlite3.connect(
+        path,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        cached_statements=current_app.config['DATABASE_STATEMENT_CACHE'],
+        # blog.index queries the shards in worker threads (see map_shards()),
+        # each connection is still only used by one thread at a time
+        check_same_thread=False
+    )
+    # Define which type a data row is returned as (here: sqlite3.Row)
+    db.row_factory = sqlite3.Row
+    return db
+
+
 # use 'g' (application context object) to store request as attribute
 # 'current_app' is used since ./__init__.py does not save the 'app' variable
 # hence it is not available here without importing it
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
+# g.dbs holds one connection per database file
+def _get_connection(path):
+    if 'dbs' not in g:
+        g.dbs = {}
+    if path not in g.dbs:
+        g.dbs[path] = connect(path)
+
+    return g.dbs[path]
+
+
+# without 'author_id', the connection to 'DATABASE' is returned, otherwise
+# the connection to the shard holding the author's posts
+def get_db(author_id=None):
+    if author_id is None:
+        return _get_connection(current_app.config['DATABASE'])
+
+    return get_shard_db(get_shard_index(author_id))
+
+
+def get_shard_db(index):
+    return _get_connection(get_shards()[index])
+
+
+def get_shard_dbs():
+    return [get_shard_db(index) for index in range(len(get_shards()))]
+
+
+# calls func(db) for the connection of each shard and returns the results in
+# shard order. With more than one shard the calls run in parallel threads.
+def map_shards(func):
+    dbs = get_shard_dbs()
+    if len(dbs) == 1:
+        return [func(dbs[0])]
+
+    return list(current_app.extensions['shard_executor'].map(func, dbs))
+
+
+# An existing single file deployment keeps its posts in 'DATABASE'. When it
+# is sharded, 'DATABASE' must stay the first shard, otherwise its posts
+# would disappear from the index and the feeds and their ids would point to
+# the wrong shard. Raises a RuntimeError for such a config
+def check_shards(app):
+    database = app.config['DATABASE']
+    shards = app.config['DATABASE_SHARDS']
+    if not shards or shards[0] == database or not os.path.exists(database):
+        return
+
+    db = sqlite3.connect(database)
+    try:
+        has_posts = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post'"
+        ).fetchone() is not None and db.execute(
+            'SELECT 1 FROM post LIMIT 1'
+        ).fetchone() is not None
+    finally:
+        db.close()
+
+    if has_posts:
+        raise RuntimeError(
+            'DATABASE {} holds posts, it must be the first entry of'
+            ' DATABASE_SHARDS.'.format(database)
         )
-        # Define which type a data row is returned as (here: sqlite3.Row)
-        g.db.row_factory = sqlite3.Row
 
-    return g.db
+
+# default number of concurrent requests map_shards() has threads for, see
+# 'DATABASE_SHARD_THREADS'
+SHARD_REQUESTS = 8
 
 
 def close_db(e=None):
-    # Remove database from 'g'
-    db = g.pop('db', None)
+    # Remove the databases from 'g'
+    dbs = g.pop('dbs', {})
 
-    # If still there, it is closed
-    if db is not None:
+    # If still there, they are closed. Before that, 'PRAGMA optimize' lets
+    # sqlite refresh the statistics of the tables this connection's queries
+    # used, as recommended for short lived connections. It is only an
+    # optimization, so a failure must not break the request
+    for db in dbs.values():
+        try:
+            db.execute('PRAGMA optimize')
+        except sqlite3.Error:
+            pass
         db.close()
 
 
-def init_db():
-    db = get_db()
+def _get_schema():
     # open schema.sql file for application (same as 'open' in common python)
     with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+        return f.read().decode('utf8')
+
+
+# (re)creates the tables of one database file, dropping its data
+def _create_tables(path, schema):
+    db = _get_connection(path)
+    db.executescript(schema)
+    # let the post ids of shard N start at N << POST_ID_SHIFT
+    shards = get_shards()
+    if path in shards and shards.index(path) > 0:
+        db.execute(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('post', ?)",
+            (shards.index(path) << POST_ID_SHIFT,)
+        )
+        db.commit()
+
+
+def init_db():
+    schema = _get_schema()
+    for path in get_database_paths():
+        _create_tables(path, schema)
+
+
+# brings a database created by an older schema.sql up to date, keeping its
+# data. Every statement can be run any number of times
+UPGRADE_SCRIPT = '''
+CREATE INDEX IF NOT EXISTS post_created ON post (created, id);
+CREATE TABLE IF NOT EXISTS post_change (
+  version INTEGER NOT NULL,
+  changed TIMESTAMP
+);
+INSERT INTO post_change (version)
+  SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM post_change);
+'''
+
+
+def upgrade_db(db=None):
+    db = db or get_db()
+    # sqlite has no 'ADD COLUMN IF NOT EXISTS'
+    columns = [row[1] for row in db.execute('PRAGMA table_info(post)')]
+    if 'updated' not in columns:
+        db.execute('ALTER TABLE post ADD COLUMN updated TIMESTAMP')
+    db.executescript(UPGRADE_SCRIPT)
+
+
+# creates the tables of the database files that don't have them yet (e.g. a
+# shard appended to 'DATABASE_SHARDS') and upgrades all other files without
+# touching their data. Returns the paths of the newly initialized files
+def init_shards():
+    schema = _get_schema()
+    initialized = []
+    for path in get_database_paths():
+        db = _get_connection(path)
+        if db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post'"
+        ).fetchone() is None:
+            _create_tables(path, schema)
+            initialized.append(path)
+        else:
+            upgrade_db(db)
+
+    return initialized
 
 # define click command
 @click.command('init-db')
@@ -46,6 +248,156 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('init-shards')
+@with_appcontext
+def init_shards_command():
+    """Create the tables in new shards and upgrade the existing databases.
+
+    All existing data is kept.
+    """
+    for path in init_shards():
+        click.echo('Initialized {}.'.format(path))
+    click.echo('All shards are initialized.')
+
+
+# Maintenance helpers. These can be run by hand or scheduled (e.g. from cron)
+# via the CLI commands below, so the database file does not keep growing and
+# the query planner statistics do not go stale over time.
+
+# copy the live database into 'path' using sqlite's online backup API
+# the copy is done in batches of 'pages' pages. Between two batches the source
+# database is released, so writers are never blocked for long
+def backup_db(path, pages=256, progress=None, db=None):
+    target = sqlite3.connect(path)
+    try:
+        (db or get_db()).backup(target, pages=pages, progress=progress)
+    finally:
+        target.close()
+
+
+# value of 'PRAGMA auto_vacuum' for INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+# 'incremental' only frees up to 'pages' pages from the freelist (all of them
+# if 'pages' is None), which requires 'auto_vacuum = INCREMENTAL' (see
+# schema.sql). Databases created before that setting don't have it, a full
+# VACUUM rebuilds the whole file and switches it to INCREMENTAL on the way
+def vacuum_db(incremental=False, pages=None, db=None):
+    db = db or get_db()
+    if incremental:
+        if db.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            raise ValueError(
+                'Incremental vacuum is not enabled for this database,'
+                ' run a full vacuum first.'
+            )
+
+        # the pragma frees one page per step, 'execute()' would only do a
+        # single step while 'executescript()' runs it to completion
+        if pages is None:
+            db.executescript('PRAGMA incremental_vacuum;')
+        else:
+            db.executescript('PRAGMA incremental_vacuum({:d});'.format(pages))
+    else:
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+
+
+# 'PRAGMA optimize' only re-analyzes tables whose statistics are likely to be
+# outdated and is cheap enough to run often. 'ANALYZE' rebuilds all of them.
+# Before sqlite 3.46, 'PRAGMA optimize' only looks at the tables used by the
+# queries of the same connection, which is nothing for a fresh connection as
+# the CLI's. Since 3.46, the 0x10000 flag makes it check all tables instead
+def optimize_db(analyze=False, db=None):
+    db = db or get_db()
+    if analyze or sqlite3.sqlite_version_info < (3, 46, 0):
+        db.execute('ANALYZE')
+    else:
+        db.execute('PRAGMA optimize=0x10002')
+    db.commit()
+
+
+CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+
+# copy the content of the write-ahead log back into the database file
+# returns a (busy, log, checkpointed) tuple, see
+# https://www.sqlite.org/pragma.html#pragma_wal_checkpoint
+def checkpoint_db(mode='PASSIVE', db=None):
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError('Unknown checkpoint mode {}.'.format(mode))
+
+    return tuple((db or get_db()).execute(
+        'PRAGMA wal_checkpoint({})'.format(mode)
+    ).fetchone())
+
+
+@click.command('db-backup')
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--pages', default=256, show_default=True,
+              help='Number of pages copied per batch.')
+@with_appcontext
+def backup_db_command(path, pages):
+    """Copy the database into PATH while it stays online.
+
+    Each additional shard N is copied into PATH.shardN.
+    """
+    def progress(status, remaining, total):
+        click.echo('Copied {} of {} pages.'.format(total - remaining, total))
+
+    shards = get_shards()
+    for source in get_database_paths():
+        target = path
+        if source != current_app.config['DATABASE']:
+            target = '{}.shard{}'.format(path, shards.index(source))
+        backup_db(target, pages=pages, progress=progress,
+                  db=_get_connection(source))
+        click.echo('Backed up {} to {}.'.format(source, target))
+
+
+@click.command('db-vacuum')
+@click.option('--incremental', is_flag=True,
+              help='Only free pages from the freelist.')
+@click.option('--pages', type=int,
+              help='Maximum number of pages freed by --incremental.')
+@with_appcontext
+def vacuum_db_command(incremental, pages):
+    """Reclaim unused space in the database file."""
+    for path in get_database_paths():
+        try:
+            vacuum_db(incremental=incremental, pages=pages,
+                      db=_get_connection(path))
+        except ValueError as e:
+            raise click.ClickException('{} ({})'.format(e, path))
+        click.echo('Vacuumed {}.'.format(path))
+
+
+@click.command('db-optimize')
+@click.option('--analyze', is_flag=True,
+              help='Rebuild all statistics instead of only the stale ones.')
+@with_appcontext
+def optimize_db_command(analyze):
+    """Refresh the query planner statistics."""
+    for path in get_database_paths():
+        optimize_db(analyze=analyze, db=_get_connection(path))
+        click.echo('Optimized {}.'.format(path))
+
+
+@click.command('db-checkpoint')
+@click.option('--mode', default='PASSIVE', show_default=True,
+              type=click.Choice(CHECKPOINT_MODES, case_sensitive=False))
+@with_appcontext
+def checkpoint_db_command(mode):
+    """Checkpoint the write-ahead log into the database file."""
+    for path in get_database_paths():
+        busy, log, checkpointed = checkpoint_db(
+            mode.upper(), db=_get_connection(path)
+        )
+        click.echo('Checkpointed {} of {} WAL frames of {}{}.'.format(
+            checkpointed, log, path, ' (database busy)' if busy else ''
+        ))
+
+
 def init_app(app):
     # 'close_db()' and 'init_db_command()' functions must be registered to be
     # available from within the application instance. Since the application is
@@ -69,7 +421,30 @@ def init_app(app):
     # tell flask to call the 'close_db()' function when application context ends
     # an application context ends when
     app.teardown_appcontext(close_db)
+    check_shards(app)
+    # the worker threads of map_shards(), shared by all requests. Each index
+    # request needs one thread per shard, so by default there are enough for
+    # SHARD_REQUESTS concurrent requests. The threads are started on demand
+    # and stopped when the application is garbage collected or the process
+    # exits
+    threads = app.config['DATABASE_SHARD_THREADS']
+    if threads is None:
+        shards = app.config['DATABASE_SHARDS'] or [app.config['DATABASE']]
+        threads = len(shards) * SHARD_REQUESTS
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=threads, thread_name_prefix='flaskr-shard'
+    )
+    app.extensions['shard_executor'] = executor
+    weakref.finalize(app, executor.shutdown, wait=False)
     # Here we add a new cli command, which is the function init_db_command
     # Since above, this is defined as click command (@click.command('init-db'))
     # it can now be executed via: flask init-db
     app.cli.add_command(init_db_command)
+    # flask init-shards, to be run after appending a shard
+    app.cli.add_command(init_shards_command)
+    # the maintenance commands: flask db-backup, db-vacuum, db-optimize and
+    # db-checkpoint
+    app.cli.add_command(backup_db_command)
+    app.cli.add_command(vacuum_db_command)
+    app.cli.add_command(optimize_db_command)
+    app.cli.add_command(checkpoint_db_command)
@@ -0,0 +1,173 @@
+import datetime
+import email.utils
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import (
+    Blueprint, current_app, make_response, render_template, request
+)
+from markupsafe import Markup
+
+from flaskr.db import get_shard_dbs
+from flaskr.queries import posts
+
+# Atom and RSS feeds of the newest posts, served at /feed.atom and /feed.rss
+bp = Blueprint('feed', __name__)
+
+FORMATS = {
+    'atom': 'application/atom+xml',
+    'rss': 'application/rss+xml',
+}
+
+
+# The rendered feed entries are cached per application. 'high_water' holds
+# the id of the newest cached post and the change marker version of each
+# shard: as long as neither changes, a poll only costs one small query per
+# shard and a comparison of the ETag. Newer posts are rendered and merged into
+# the cache, all other entries are reused. Updating or deleting a post bumps
+# the version stored in the database, which makes every process's cache start
+# over.
+class FeedCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.high_water = None
+        # time of the last post update or delete over all shards, or None
+        self.changed = None
+        # list of (id, created, {format: rendered entry}), newest first
+        self.entries = []
+        # {format: (body, etag, last_modified)}
+        self.feeds = {}
+
+
+# The rendered entries contain absolute links built from the host and scheme
+# of the request, so each host URL gets its own cache. The Host header is
+# chosen by the client, hence only the MAX_HOSTS most recently used are kept.
+MAX_HOSTS = 8
+
+
+class FeedCaches(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.caches = OrderedDict()
+
+    def get(self, host_url):
+        with self.lock:
+            if host_url in self.caches:
+                self.caches.move_to_end(host_url)
+            else:
+                self.caches[host_url] = FeedCache()
+                if len(self.caches) > MAX_HOSTS:
+                    self.caches.popitem(last=False)
+            return self.caches[host_url]
+
+
+# the cache for the host URL of the current request
+def get_cache():
+    return current_app.extensions['feed_caches'].get(request.host_url)
+
+
+# render all entries of the posts newer than the cache's high water marks
+def _refresh(cache):
+    dbs = get_shard_dbs()
+    states = [posts(db).feed_state() for db in dbs]
+    high_water = tuple((state['max_id'] or 0, state['version']) for state in states)
+    if high_water == cache.high_water:
+        return
+
+    # a post was updated or deleted or the shards changed, start over
+    if cache.high_water is None or len(high_water) != len(cache.high_water) \
+            or any(new[1] != old[1] for new, old in zip(high_water, cache.high_water)):
+        cache.clear()
+
+    length = current_app.config['FEED_LENGTH']
+    since = [old[0] for old in cache.high_water or ((0, 0),) * len(dbs)]
+    # only posts up to the high water mark are fetched: posts committed after
+    # feed_state() are left for the next poll, otherwise they would be cached
+    # now and fetched once more then
+    new_entries = [
+        (post['id'], post['created'], {
+            format: render_template('feed/{}_entry.xml'.format(format), post=post)
+            for format in FORMATS
+        })
+        for db, id, (max_id, version) in zip(dbs, since, high_water)
+        for post in posts(db).newer_than(id, max_id, length)
+    ]
+    # newest first, over all shards
+    cache.entries = sorted(
+        new_entries + cache.entries,
+        key=lambda entry: (entry[1], entry[0]), reverse=True
+    )[:length]
+    cache.high_water = high_water
+    cache.changed = max(
+        (state['changed'] for state in states if state['changed'] is not None),
+        default=None
+    )
+    cache.feeds.clear()
+
+
+def _get_feed(format):
+    cache = get_cache()
+    with cache.lock:
+        _refresh(cache)
+
+        if format not in cache.feeds:
+            # the feed last changed when its newest post was created or when
+            # a post was last updated or deleted, whichever is later. Both
+            # come from the database, so all processes agree on it
+            dates = [entry[1] for entry in cache.entries[:1]]
+            if cache.changed is not None:
+                dates.append(cache.changed)
+            last_modified = max(dates, default=None)
+            body = render_template(
+                'feed/{}.xml'.format(format),
+                entries=Markup(''.join(entry[2][format] for entry in cache.entries)),
+                # a feed without any posts has never been updated
+                updated=last_modified or datetime.datetime(1970, 1, 1),
+            )
+            etag = hashlib.sha1(body.encode('utf8')).hexdigest()
+            cache.feeds[format] = (body, etag, last_modified)
+
+        return cache.feeds[format]
+
+
+def _feed_response(format):
+    body, etag, last_modified = _get_feed(format)
+    response = make_response(body)
+    response.mimetype = FORMATS[format]
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # turns the response into '304 Not Modified' without a body if the
+    # client's If-None-Match / If-Modified-Since headers match
+    return response.make_conditional(request)
+
+
+@bp.route('/feed.atom')
+def atom():
+    return _feed_response('atom')
+
+
+@bp.route('/feed.rss')
+def rss():
+    return _feed_response('rss')
+
+
+# date formats used by the feed templates, the 'created' timestamps are UTC
+@bp.app_template_filter()
+def atom_date(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+@bp.app_template_filter()
+def rss_date(value):
+    return email.utils.format_datetime(
+        value.replace(tzinfo=datetime.timezone.utc), usegmt=True
+    )
+
+
+def init_app(app):
+    app.extensions['feed_caches'] = FeedCaches()
+    app.register_blueprint(bp)
@@ -0,0 +1,265 @@
+import threading
+import time
+
+import click
+from flask import current_app, jsonify
+from flask.cli import with_appcontext
+
+from flaskr.db import get_db
+
+# All SQL statements of the application are registered here once, under a name.
+# Since the statement strings never change, sqlite3 keeps them prepared in the
+# per-connection statement cache (see 'DATABASE_STATEMENT_CACHE' in
+# create_app()). A connection only lives as long as its application context
+# (see db.close_db()), so this saves preparing a statement again when it is
+# run more than once within one request or CLI command, not across requests.
+QUERIES = {}
+
+
+def register(name, sql):
+    if name in QUERIES:
+        raise ValueError('Query {} is already registered.'.format(name))
+
+    QUERIES[name] = sql
+    return name
+
+
+register('user.by_id', 'SELECT * FROM user WHERE id = ?')
+register('user.by_username', 'SELECT * FROM user WHERE username = ?')
+register('user.create', 'INSERT INTO user (username, password) VALUES (?, ?)')
+register(
+    'user.copy',
+    'INSERT OR IGNORE INTO user (id, username, password) VALUES (?, ?, ?)'
+)
+
+register(
+    'post.page',
+    'SELECT p.id, title, body, created, author_id, username'
+    ' FROM post p JOIN user u ON p.author_id = u.id'
+    ' ORDER BY created DESC, p.id DESC LIMIT ?'
+)
+register(
+    'post.page_before',
+    'SELECT p.id, title, body, created, author_id, username'
+    ' FROM post p JOIN user u ON p.author_id = u.id'
+    ' WHERE (created, p.id) < (?, ?)'
+    ' ORDER BY created DESC, p.id DESC LIMIT ?'
+)
+register(
+    'post.by_id',
+    'SELECT p.id, title, body, created, author_id, username'
+    ' FROM post p JOIN user u ON p.author_id = u.id'
+    ' WHERE p.id = ?'
+)
+register(
+    'post.newer_than',
+    'SELECT p.id, title, body, created, updated, author_id, username'
+    ' FROM post p JOIN user u ON p.author_id = u.id'
+    ' WHERE p.id > ? AND p.id <= ?'
+    ' ORDER BY p.id DESC LIMIT ?'
+)
+register(
+    'post.feed_state',
+    'SELECT (SELECT MAX(id) FROM post) AS max_id, version, changed'
+    ' FROM post_change'
+)
+register(
+    'post.touch',
+    'UPDATE post_change SET version = version + 1, changed = CURRENT_TIMESTAMP'
+)
+register(
+    'post.create',
+    'INSERT INTO post (title, body, author_id) VALUES (?, ?, ?)'
+)
+register(
+    'post.update',
+    'UPDATE post SET title = ?, body = ?, updated = CURRENT_TIMESTAMP'
+    ' WHERE id = ?'
+)
+register('post.delete', 'DELETE FROM post WHERE id = ?')
+
+
+# collects the number of calls and the total time spent per query name
+# a single instance is shared by all requests of an application (see
+# init_app()), hence the lock
+class QueryTimings(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def record(self, name, seconds):
+        with self._lock:
+            count, total = self._timings.get(name, (0, 0.0))
+            self._timings[name] = (count + 1, total + seconds)
+
+    # returns a {name: (count, total seconds)} copy of the collected timings
+    def snapshot(self):
+        with self._lock:
+            return dict(self._timings)
+
+    def clear(self):
+        with self._lock:
+            self._timings.clear()
+
+
+# base class of the per-table repositories, which run the registered queries
+# on the given connection and record how long each of them took (including
+# fetching the rows)
+class Repository(object):
+    def __init__(self, db, timings=None):
+        self._db = db
+        self._timings = timings
+
+    def _run(self, name, params, fetch):
+        start = time.perf_counter()
+        cursor = self._db.execute(QUERIES[name], params)
+        result = fetch(cursor)
+        if self._timings is not None:
+            self._timings.record(name, time.perf_counter() - start)
+        return result
+
+    def _fetchone(self, name, params=()):
+        return self._run(name, params, lambda cursor: cursor.fetchone())
+
+    def _fetchall(self, name, params=()):
+        return self._run(name, params, lambda cursor: cursor.fetchall())
+
+    # returns the id of the inserted row
+    def _write(self, name, params=()):
+        return self._run(name, params, lambda cursor: cursor.lastrowid)
+
+    # runs the same statement for each parameter tuple in 'seq_of_params'
+    # and returns the number of changed rows
+    def _write_many(self, name, seq_of_params):
+        start = time.perf_counter()
+        cursor = self._db.executemany(QUERIES[name], seq_of_params)
+        if self._timings is not None:
+            self._timings.record(name, time.perf_counter() - start)
+        return cursor.rowcount
+
+
+class UserRepository(Repository):
+    def get(self, id):
+        return self._fetchone('user.by_id', (id,))
+
+    def get_by_username(self, username):
+        return self._fetchone('user.by_username', (username,))
+
+    def create(self, username, password_hash):
+        return self._write('user.create', (username, password_hash))
+
+    # 'users' is an iterable of (username, password_hash) tuples
+    def create_many(self, users):
+        return self._write_many('user.create', users)
+
+    # copies a user row (with its id) from another database, unless it is
+    # already there
+    def copy(self, user):
+        self._write('user.copy', (user['id'], user['username'], user['password']))
+
+
+class PostRepository(Repository):
+    # the newest 'limit' posts, or those right before the post given by its
+    # 'created' and 'id' values (keyset pagination)
+    def page(self, limit, created=None, id=None):
+        if created is None:
+            return self._fetchall('post.page', (limit,))
+
+        return self._fetchall('post.page_before', (created, id, limit))
+
+    def get(self, id):
+        return self._fetchone('post.by_id', (id,))
+
+    # the newest 'limit' posts with an id greater than 'id' and at most
+    # 'max_id', newest first
+    def newer_than(self, id, max_id, limit):
+        return self._fetchall('post.newer_than', (id, max_id, limit))
+
+    # the id of the newest post (None if there are no posts), the number of
+    # post updates and deletes and the time of the last one
+    def feed_state(self):
+        return self._fetchone('post.feed_state')
+
+    def create(self, title, body, author_id):
+        return self._write('post.create', (title, body, author_id))
+
+    # 'posts' is an iterable of (title, body, author_id) tuples
+    def create_many(self, posts):
+        return self._write_many('post.create', posts)
+
+    # update() and delete() also bump the change marker in the same
+    # transaction, see feed_state()
+    def update(self, id, title, body):
+        self._write('post.update', (title, body, id))
+        self._write('post.touch')
+
+    def delete(self, id):
+        self._write('post.delete', (id,))
+        self._write('post.touch')
+
+
+def get_timings():
+    return current_app.extensions['query_timings']
+
+
+# repositories bound to the given connection (or to 'DATABASE')
+# writes still have to be committed via db.commit()
+def users(db=None):
+    return UserRepository(db or get_db(), get_timings())
+
+
+def posts(db=None):
+    return PostRepository(db or get_db(), get_timings())
+
+
+# returns the 'EXPLAIN QUERY PLAN' rows of a registered query
+# all parameters are bound to NULL, which is enough for sqlite to plan it
+def explain(db, name):
+    sql = QUERIES[name]
+    return db.execute(
+        'EXPLAIN QUERY PLAN ' + sql, (None,) * sql.count('?')
+    ).fetchall()
+
+
+@click.command('db-explain')
+@click.argument('names', nargs=-1)
+@with_appcontext
+def explain_command(names):
+    """Show the query plan of the given (or all) registered queries."""
+    db = get_db()
+    for name in names or sorted(QUERIES):
+        if name not in QUERIES:
+            raise click.BadParameter(
+                'Unknown query {}.'.format(name), param_hint='NAMES'
+            )
+
+        click.echo('{}: {}'.format(name, QUERIES[name]))
+        for row in explain(db, name):
+            click.echo('  ' + row['detail'])
+
+
+# the collected timings as JSON, the most expensive queries first
+def timings_view():
+    timings = get_timings().snapshot()
+    return jsonify([
+        {
+            'name': name,
+            'count': count,
+            'total': total,
+            'mean': total / count,
+            'sql': QUERIES[name],
+        }
+        for name, (count, total) in sorted(
+            timings.items(), key=lambda item: item[1][1], reverse=True
+        )
+    ])
+
+
+def init_app(app):
+    # one QueryTimings instance per application, see get_timings()
+    app.extensions['query_timings'] = QueryTimings()
+    app.cli.add_command(explain_command)
+    # the timings contain the application's SQL, so they are only served
+    # when enabled in the config (e.g. during development)
+    if app.config['QUERY_TIMINGS_ENDPOINT']:
+        app.add_url_rule('/_queries', 'query_timings', timings_view)
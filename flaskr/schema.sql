@@ -1,5 +1,14 @@
+-- both settings are stored in the database file itself
+-- auto_vacuum must be set before any table is created (or be followed by a
+-- VACUUM), it allows 'flask db-vacuum --incremental' to shrink the file
+PRAGMA auto_vacuum = INCREMENTAL;
+-- write-ahead logging lets readers and writers work concurrently, the log is
+-- written back by 'flask db-checkpoint' (or automatically by sqlite)
+PRAGMA journal_mode = WAL;
+
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS post;
+DROP TABLE IF EXISTS post_change;
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -11,7 +20,23 @@ CREATE TABLE post (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   author_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  -- set when the post is edited, NULL before that
+  updated TIMESTAMP,
   title TEXT NOT NULL,
   body TEXT NOT NULL,
   FOREIGN KEY (author_id) REFERENCES user (id)
 );
+
+-- the index pages walk through the posts in this order, see blog.index
+CREATE INDEX post_created ON post (created, id);
+
+-- changes to the tables must also be added to UPGRADE_SCRIPT in db.py, so
+-- existing databases can be upgraded with 'flask init-shards'
+
+-- a single row, bumped by every update or delete of a post (see queries.py)
+-- so the feed caches of all processes notice changed posts, see feed.py
+CREATE TABLE post_change (
+  version INTEGER NOT NULL,
+  changed TIMESTAMP
+);
+INSERT INTO post_change (version) VALUES (0);
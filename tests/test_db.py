@@ -1,6 +1,7 @@
 import sqlite3
 
 import pytest
+from flaskr import create_app
 from flaskr.db import get_db # get database content as dict
 
 # test if the database returns the same content each time it is called.
@@ -41,3 +42,146 @@ def test_init_db_command(runner, monkeypatch):
     assert 'Initialized' in result.output
     # Checking if fake_init_db executed
     assert Recorder.called
+
+
+# back up the test database into a second file and check that the copy
+# contains the test post
+def test_db_backup_command(runner, app, tmp_path):
+    path = str(tmp_path / 'backup.sqlite')
+    result = runner.invoke(args=['db-backup', path, '--pages', '1'])
+    assert 'Backed up' in result.output
+    # with one page per batch, the progress is reported more than once
+    assert result.output.count('Copied') > 1
+
+    backup = sqlite3.connect(path)
+    try:
+        assert backup.execute('SELECT title FROM post').fetchone()[0] == 'test title'
+    finally:
+        backup.close()
+
+
+# deleting rows leaves free pages behind, which the incremental vacuum removes
+def test_db_vacuum_command(runner, app):
+    with app.app_context():
+        db = get_db()
+        assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)',
+            [('t', 'x' * 1000)] * 100
+        )
+        db.commit()
+        db.execute('DELETE FROM post')
+        db.commit()
+        assert db.execute('PRAGMA freelist_count').fetchone()[0] > 0
+
+    result = runner.invoke(args=['db-vacuum', '--incremental'])
+    assert 'Vacuumed' in result.output
+
+    with app.app_context():
+        assert get_db().execute('PRAGMA freelist_count').fetchone()[0] == 0
+
+    assert 'Vacuumed' in runner.invoke(args=['db-vacuum']).output
+
+
+# the statistics of the indexed tables are written to sqlite_stat1
+@pytest.mark.parametrize('args', (
+    ['db-optimize'],
+    ['db-optimize', '--analyze'],
+))
+def test_db_optimize_command(runner, app, args):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)',
+            [('t', '')] * 100
+        )
+        db.commit()
+
+    assert 'Optimized' in runner.invoke(args=args).output
+
+    with app.app_context():
+        tables = {row[0] for row in get_db().execute(
+            'SELECT tbl FROM sqlite_stat1'
+        ).fetchall()}
+        assert {'post', 'user'} <= tables
+
+
+# request connections run 'PRAGMA optimize' when they are closed
+def test_close_db_optimize(app):
+    statements = []
+
+    with app.app_context():
+        db = get_db()
+        db.set_trace_callback(statements.append)
+
+    assert 'PRAGMA optimize' in statements
+
+
+def test_db_checkpoint_command(runner):
+    result = runner.invoke(args=['db-checkpoint', '--mode', 'truncate'])
+    assert 'Checkpointed' in result.output
+    assert 'busy' not in result.output
+
+
+# databases created without 'auto_vacuum = INCREMENTAL' need a full vacuum
+# before the incremental one can free anything
+def test_db_vacuum_command_not_incremental(runner, app):
+    with app.app_context():
+        db = get_db()
+        db.execute('PRAGMA auto_vacuum = NONE')
+        db.execute('VACUUM')
+        assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 0
+
+    result = runner.invoke(args=['db-vacuum', '--incremental'])
+    assert result.exit_code != 0
+    assert 'run a full vacuum first' in result.output
+    assert 'Vacuumed' not in result.output
+
+    assert 'Vacuumed' in runner.invoke(args=['db-vacuum']).output
+
+    with app.app_context():
+        assert get_db().execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+# a database created by the first version of schema.sql is upgraded by
+# 'init-shards' without losing its posts
+def test_init_shards_upgrade(tmp_path):
+    path = str(tmp_path / 'old.sqlite')
+    old = sqlite3.connect(path)
+    old.executescript('''
+        CREATE TABLE user (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          username TEXT UNIQUE NOT NULL,
+          password TEXT NOT NULL
+        );
+        CREATE TABLE post (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          author_id INTEGER NOT NULL,
+          created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+          title TEXT NOT NULL,
+          body TEXT NOT NULL,
+          FOREIGN KEY (author_id) REFERENCES user (id)
+        );
+        INSERT INTO user (username, password) VALUES ('test', 'x');
+        INSERT INTO post (title, body, author_id) VALUES ('old post', '', 1);
+    ''')
+    old.close()
+
+    app = create_app({'TESTING': True, 'DATABASE': path})
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['init-shards'])
+    assert 'Initialized ' not in result.output
+    # running it twice doesn't add a second change marker row
+    runner.invoke(args=['init-shards'])
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT COUNT(*) FROM post_change').fetchone()[0] == 1
+        assert db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'post_created'"
+        ).fetchone() is not None
+        assert 'updated' in [row[1] for row in db.execute('PRAGMA table_info(post)')]
+
+    response = app.test_client().get('/feed.atom')
+    assert response.status_code == 200
+    assert b'old post' in response.data
@@ -0,0 +1,182 @@
+import sqlite3
+
+import pytest
+from flaskr import create_app
+from flaskr.db import get_db
+from flaskr.feed import get_cache
+from flaskr.queries import PostRepository, get_timings
+
+
+@pytest.mark.parametrize(('path', 'mimetype', 'date'), (
+    ('/feed.atom', 'application/atom+xml', b'2018-01-01T00:00:00Z'),
+    ('/feed.rss', 'application/rss+xml', b'Mon, 01 Jan 2018 00:00:00 GMT'),
+))
+def test_feed(client, path, mimetype, date):
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.mimetype == mimetype
+    assert b'test title' in response.data
+    assert b'http://localhost/#post-1' in response.data
+    assert date in response.data
+
+
+# a matching ETag or modification date results in 304 Not Modified
+def test_feed_conditional(client):
+    response = client.get('/feed.atom')
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+
+    response = client.get('/feed.atom', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    response = client.get(
+        '/feed.atom', headers={'If-Modified-Since': last_modified}
+    )
+    assert response.status_code == 304
+
+
+# Last-Modified comes from the data: the newest post's creation, or the last
+# update or delete of a post if that is later
+def test_feed_last_modified(client, auth, app):
+    response = client.get('/feed.rss')
+    assert response.headers['Last-Modified'] == 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+    # another application (as another worker process) sends the same date
+    other = create_app({'TESTING': True, 'DATABASE': app.config['DATABASE']})
+    assert other.test_client().get('/feed.rss').headers['Last-Modified'] \
+        == 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+    auth.login()
+    client.post('/1/update', data={'title': 'updated', 'body': ''})
+    response = client.get(
+        '/feed.rss', headers={'If-Modified-Since': 'Mon, 01 Jan 2018 00:00:00 GMT'}
+    )
+    assert response.status_code == 200
+    assert b'updated' in response.data
+    assert response.last_modified.year > 2018
+
+
+# only posts newer than the cached ones are queried and rendered
+def test_feed_incremental(client, auth, app):
+    client.get('/feed.atom')
+    with app.app_context():
+        timings = get_timings()
+        timings.clear()
+
+    etag = client.get('/feed.atom').headers['ETag']
+    with app.app_context():
+        # nothing changed, so only the newest id was looked up
+        assert 'post.newer_than' not in timings.snapshot()
+
+    auth.login()
+    client.post('/create', data={'title': 'created', 'body': ''})
+    response = client.get('/feed.atom', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'created' in response.data
+    assert b'test title' in response.data
+
+    with app.test_request_context():
+        assert [entry[0] for entry in get_cache().entries] == [2, 1]
+
+
+# a post committed (by another connection) between reading the feed state
+# and fetching the new posts is left for the next poll, not cached twice
+def test_feed_concurrent_post(client, app, monkeypatch):
+    feed_state = PostRepository.feed_state
+
+    def feed_state_then_post(self):
+        state = feed_state(self)
+        other = sqlite3.connect(app.config['DATABASE'])
+        other.execute(
+            "INSERT INTO post (title, body, author_id) VALUES ('late', '', 1)"
+        )
+        other.commit()
+        other.close()
+        return state
+
+    monkeypatch.setattr(PostRepository, 'feed_state', feed_state_then_post)
+    assert b'late' not in client.get('/feed.atom').data
+    monkeypatch.setattr(PostRepository, 'feed_state', feed_state)
+
+    response = client.get('/feed.atom')
+    assert response.data.count(b'<title>late</title>') == 1
+    with app.test_request_context():
+        assert [entry[0] for entry in get_cache().entries] == [2, 1]
+
+
+def test_feed_length(client, app):
+    app.config['FEED_LENGTH'] = 2
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)',
+            [('title {}'.format(i), '') for i in range(3)]
+        )
+        db.commit()
+
+    response = client.get('/feed.rss')
+    assert response.data.count(b'<item>') == 2
+    assert b'title 2' in response.data
+    assert b'test title' not in response.data
+
+
+# updating or deleting a post drops the cached entries
+@pytest.mark.parametrize(('path', 'data'), (
+    ('/1/update', {'title': 'updated', 'body': ''}),
+    ('/1/delete', {}),
+))
+def test_feed_invalidate(client, auth, path, data):
+    assert b'test title' in client.get('/feed.atom').data
+
+    auth.login()
+    client.post(path, data=data)
+    assert b'test title' not in client.get('/feed.atom').data
+
+
+# a second application (as another worker process) on the same database
+# notices the change through the database, not through its own cache
+def test_feed_invalidate_other_process(client, auth, app):
+    other = create_app({'TESTING': True, 'DATABASE': app.config['DATABASE']})
+    other_client = other.test_client()
+    response = other_client.get('/feed.atom')
+    assert b'test title' in response.data
+    etag = response.headers['ETag']
+
+    auth.login()
+    client.post('/1/update', data={'title': 'updated', 'body': ''})
+
+    response = other_client.get('/feed.atom', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'updated' in response.data
+    assert b'test title' not in response.data
+
+
+# each host gets its own links (and ETag)
+def test_feed_per_host(client):
+    response = client.get('/feed.atom', base_url='http://a.example')
+    assert b'http://a.example/#post-1' in response.data
+
+    other = client.get('/feed.atom', base_url='https://b.example')
+    assert b'https://b.example/#post-1' in other.data
+    assert b'a.example' not in other.data
+    assert other.headers['ETag'] != response.headers['ETag']
+
+
+# an edited post gets a newer Atom 'updated' date, its RSS item names the
+# author with dc:creator
+def test_feed_entry_dates_and_author(client, auth):
+    data = client.get('/feed.atom').data
+    assert b'<published>2018-01-01T00:00:00Z</published>' in data
+    assert b'<updated>2018-01-01T00:00:00Z</updated>' in data
+
+    data = client.get('/feed.rss').data
+    assert b'xmlns:dc="http://purl.org/dc/elements/1.1/"' in data
+    assert b'<dc:creator>test</dc:creator>' in data
+    assert b'<author>' not in data
+
+    auth.login()
+    client.post('/1/update', data={'title': 'updated', 'body': ''})
+    data = client.get('/feed.atom').data
+    assert b'<published>2018-01-01T00:00:00Z</published>' in data
+    assert data.count(b'<updated>2018-01-01T00:00:00Z</updated>') == 0
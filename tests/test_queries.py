@@ -0,0 +1,95 @@
+import pytest
+from flaskr import create_app
+from flaskr.db import get_db
+from flaskr.queries import (
+    QUERIES, PostRepository, QueryTimings, get_timings, posts, register, users
+)
+
+
+# a query name can only be registered once
+def test_register_duplicate():
+    with pytest.raises(ValueError):
+        register('post.by_id', 'SELECT 1')
+
+
+def test_repositories(app):
+    with app.app_context():
+        assert users().get_by_username('test')['id'] == 1
+        assert users().get(2)['username'] == 'other'
+        assert posts().get(1)['title'] == 'test title'
+
+        id = posts().create('created', '', 2)
+        posts().update(id, 'updated', 'body')
+        assert posts().get(id)['title'] == 'updated'
+        assert [post['id'] for post in posts().page(10)] == [id, 1]
+        assert [post['id'] for post in posts().page(1)] == [id]
+        post = posts().get(id)
+        assert [p['id'] for p in posts().page(10, str(post['created']), id)] == [1]
+
+        posts().delete(id)
+        assert posts().get(id) is None
+
+
+# executemany() inserts all rows with a single prepared statement
+def test_create_many(app):
+    with app.app_context():
+        count = posts().create_many(
+            ('title {}'.format(i), '', 1) for i in range(10)
+        )
+        get_db().commit()
+        assert count == 10
+        assert len(posts().page(20)) == 11
+
+
+# each query run through a repository is counted and timed under its name
+def test_timings(app, client):
+    with app.app_context():
+        timings = get_timings()
+        timings.clear()
+        client.get('/')
+        count, total = timings.snapshot()['post.page']
+        assert count == 1
+        assert total > 0
+
+        # repositories without a QueryTimings instance do not record anything
+        PostRepository(get_db()).page(10)
+        assert timings.snapshot()['post.page'][0] == 1
+
+
+def test_query_timings():
+    timings = QueryTimings()
+    timings.record('a', 1.0)
+    timings.record('a', 0.5)
+    assert timings.snapshot() == {'a': (2, 1.5)}
+    timings.clear()
+    assert timings.snapshot() == {}
+
+
+def test_explain_command(runner):
+    result = runner.invoke(args=['db-explain'])
+    for name in QUERIES:
+        assert name + ':' in result.output
+
+    # looking a post up by id uses the primary key
+    result = runner.invoke(args=['db-explain', 'post.by_id'])
+    assert 'INTEGER PRIMARY KEY' in result.output
+
+    result = runner.invoke(args=['db-explain', 'unknown'])
+    assert result.exit_code != 0
+
+
+# the timings are only served when enabled
+def test_timings_endpoint(app, client):
+    assert client.get('/_queries').status_code == 404
+
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': app.config['DATABASE'],
+        'QUERY_TIMINGS_ENDPOINT': True,
+    })
+    client = app.test_client()
+    client.get('/')
+    timings = client.get('/_queries').get_json()
+    assert [timing['name'] for timing in timings] == ['post.page']
+    assert timings[0]['count'] == 1
+    assert timings[0]['sql'].startswith('SELECT')
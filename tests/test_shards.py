@@ -0,0 +1,219 @@
+import threading
+
+import pytest
+from flaskr import create_app
+from flaskr.db import (
+    POST_ID_SHIFT, HashRing, get_db, get_shard_db, get_shard_index, init_db,
+    map_shards
+)
+
+USERNAMES = ['user{}'.format(i) for i in range(8)]
+
+
+# an application whose posts are spread over three shards, the directory
+# database ('DATABASE') is not one of them
+@pytest.fixture
+def sharded_app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'users.sqlite'),
+        'DATABASE_SHARDS': [
+            str(tmp_path / 'shard{}.sqlite'.format(i)) for i in range(3)
+        ],
+        'POSTS_PER_PAGE': 5,
+    })
+    with app.app_context():
+        init_db()
+
+    client = app.test_client()
+    for username in USERNAMES:
+        client.post(
+            '/auth/register', data={'username': username, 'password': 'a'}
+        )
+        client.post(
+            '/auth/login', data={'username': username, 'password': 'a'}
+        )
+        client.post('/create', data={'title': 'by ' + username, 'body': ''})
+
+    return app
+
+
+# only the authors placed on the new shard move when a shard is added
+def test_hash_ring():
+    before = HashRing(3)
+    after = HashRing(4)
+    for key in range(1000):
+        assert after.get(key) in (before.get(key), 3)
+
+
+def test_posts_on_author_shard(sharded_app):
+    with sharded_app.app_context():
+        users = get_db().execute('SELECT * FROM user').fetchall()
+        assert len(users) == len(USERNAMES)
+        assert get_db().execute('SELECT * FROM post').fetchall() == []
+
+        used = set()
+        for user in users:
+            index = get_shard_index(user['id'])
+            used.add(index)
+            shard = get_shard_db(index)
+            post = shard.execute(
+                'SELECT * FROM post WHERE author_id = ?', (user['id'],)
+            ).fetchone()
+            assert post['title'] == 'by ' + user['username']
+            # the shard can be told from the post id
+            assert post['id'] >> POST_ID_SHIFT == index
+            # the user row was copied to the author's shard
+            assert shard.execute(
+                'SELECT username FROM user WHERE id = ?', (user['id'],)
+            ).fetchone()[0] == user['username']
+
+        assert len(used) > 1
+
+
+# the index merges the posts of all shards, newest first, page by page
+def test_index_merge(sharded_app):
+    client = sharded_app.test_client()
+    seen = []
+    url = '/'
+    while url:
+        response = client.get(url)
+        data = response.data.decode()
+        seen.extend(
+            username for username in USERNAMES
+            if 'by ' + username + '</h1>' in data
+        )
+        url = None
+        if 'Older posts' in data:
+            url = data.split('class="action" href="')[-1].split('"')[0]
+            url = url.replace('&amp;', '&')
+
+    assert sorted(seen) == sorted(USERNAMES)
+    assert len(seen) == len(USERNAMES)
+
+
+def test_update_delete_on_shard(sharded_app):
+    client = sharded_app.test_client()
+    client.post('/auth/login', data={'username': 'user3', 'password': 'a'})
+
+    with sharded_app.app_context():
+        user_id = get_db().execute(
+            "SELECT id FROM user WHERE username = 'user3'"
+        ).fetchone()[0]
+        shard = get_db(user_id)
+        id = shard.execute(
+            'SELECT id FROM post WHERE author_id = ?', (user_id,)
+        ).fetchone()[0]
+
+    assert client.get('/{}/update'.format(id)).status_code == 200
+    client.post('/{}/update'.format(id), data={'title': 'updated', 'body': ''})
+    assert b'updated' in client.get('/feed.atom').data
+
+    client.post('/{}/delete'.format(id))
+    with sharded_app.app_context():
+        assert get_db(user_id).execute(
+            'SELECT * FROM post WHERE id = ?', (id,)
+        ).fetchone() is None
+
+    # ids beyond the last shard don't exist
+    assert client.get('/{}/update'.format(3 << POST_ID_SHIFT)).status_code == 404
+
+
+def test_feed_all_shards(sharded_app):
+    data = sharded_app.test_client().get('/feed.rss').data
+    assert data.count(b'<item>') == len(USERNAMES)
+
+
+def test_maintenance_all_shards(sharded_app, tmp_path):
+    runner = sharded_app.test_cli_runner()
+    result = runner.invoke(args=['db-backup', str(tmp_path / 'backup.sqlite')])
+    assert result.output.count('Backed up') == 4
+    assert (tmp_path / 'backup.sqlite.shard2').exists()
+    assert runner.invoke(args=['db-optimize']).output.count('Optimized') == 4
+
+
+# appending a shard: 'init-shards' only creates the new shard's tables, and
+# an author moved to it can post there right away
+def test_append_shard(sharded_app, tmp_path):
+    shards = sharded_app.config['DATABASE_SHARDS']
+    sharded_app.config['DATABASE_SHARDS'] = shards + [
+        str(tmp_path / 'shard3.sqlite')
+    ]
+    runner = sharded_app.test_cli_runner()
+    result = runner.invoke(args=['init-shards'])
+    assert result.output.count('Initialized ') == 1
+    assert 'shard3.sqlite' in result.output
+
+    with sharded_app.app_context():
+        # the existing posts were kept
+        assert sum(
+            get_shard_db(index).execute('SELECT COUNT(*) FROM post').fetchone()[0]
+            for index in range(3)
+        ) == len(USERNAMES)
+
+        moved = [
+            user['username']
+            for user in get_db().execute('SELECT * FROM user').fetchall()
+            if get_shard_index(user['id']) == 3
+        ]
+    assert moved
+
+    client = sharded_app.test_client()
+    client.post('/auth/login', data={'username': moved[0], 'password': 'a'})
+    client.post('/create', data={'title': 'moved post', 'body': ''})
+
+    with sharded_app.app_context():
+        id = get_shard_db(3).execute(
+            "SELECT id FROM post WHERE title = 'moved post'"
+        ).fetchone()[0]
+    assert id >> POST_ID_SHIFT == 3
+
+    assert b'moved post' in client.get('/').data
+    assert b'moved post' in client.get('/feed.atom').data
+    assert client.get('/{}/update'.format(id)).status_code == 200
+    # the older posts of the moved author are still found on the old shard
+    assert ('by ' + moved[0]).encode() in client.get('/feed.atom').data
+
+    # running it again changes nothing
+    assert 'Initialized ' not in runner.invoke(args=['init-shards']).output
+
+
+# concurrent requests query their shards at the same time: each call waits
+# until the calls of both requests on all shards have started
+def test_map_shards_concurrent_requests(sharded_app):
+    barrier = threading.Barrier(6, timeout=5)
+    results = []
+
+    def wait(db):
+        barrier.wait()
+        return True
+
+    def request():
+        with sharded_app.app_context():
+            results.append(map_shards(wait))
+
+    threads = [threading.Thread(target=request) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [[True] * 3] * 2
+
+
+# an existing database with posts must stay the first shard
+def test_database_first_shard(app, tmp_path):
+    database = app.config['DATABASE']
+    other = str(tmp_path / 'other.sqlite')
+    with pytest.raises(RuntimeError):
+        create_app({
+            'TESTING': True,
+            'DATABASE': database,
+            'DATABASE_SHARDS': [other, database],
+        })
+
+    create_app({
+        'TESTING': True,
+        'DATABASE': database,
+        'DATABASE_SHARDS': [database, other],
+    })